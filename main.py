@@ -1,13 +1,18 @@
 import os
 import asyncio
+import html
 import logging
+import time
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime, timezone
+from functools import lru_cache
 from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from aiogram.filters import Command
 from aiogram.types import Message
 from web3 import Web3
-import json
 import aiohttp
+import orjson
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,6 +23,7 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 TELEGRAM_USER_ID = int(os.getenv("TELEGRAM_USER_ID"))
 BNB_RPC = os.getenv("BNB_RPC", "https://bsc-dataseed.binance.org/")
+BNB_WSS = os.getenv("BNB_WSS")  # WebSocket RPC для eth_subscribe; без него — только опрос раз в 30 секунд
 BSCSCAN_API_KEY = os.getenv("BSCSCAN_API_KEY", "YourApiKeyToken")  # Бесплатный без регистрации
 
 bot = Bot(token=BOT_TOKEN)
@@ -62,136 +68,260 @@ TOKENS = {
     }
 }
 
+# Множитель «сырое значение → токены»: умножение вместо деления на 10 ** decimals
+TOKEN_SCALES = {symbol: 10.0 ** -info["decimals"] for symbol, info in TOKENS.items()}
+
 TRANSFER_EVENT_SIGNATURE = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+# Checksum-адреса контрактов считаем один раз: to_checksum_address каждый раз хэширует адрес
+TOKEN_CONTRACTS = {
+    symbol: Web3.to_checksum_address(info["address"])
+    for symbol, info in TOKENS.items()
+    if info["address"]
+}
+TOKEN_ADDRESSES = list(TOKEN_CONTRACTS.values())
+
+# Селекторы balanceOf(address) и getEthBalance(address): calldata = селектор + адрес, дополненный до 32 байт
+BALANCE_OF_SELECTOR = bytes.fromhex("70a08231")
+GET_ETH_BALANCE_SELECTOR = bytes.fromhex("4d2301cc")
 
-ERC20_ABI = [
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+MULTICALL3_ABI = [
+    {
+        "inputs": [
+            {
+                "components": [
+                    {"name": "target", "type": "address"},
+                    {"name": "allowFailure", "type": "bool"},
+                    {"name": "callData", "type": "bytes"}
+                ],
+                "name": "calls",
+                "type": "tuple[]"
+            }
+        ],
+        "name": "aggregate3",
+        "outputs": [
+            {
+                "components": [
+                    {"name": "success", "type": "bool"},
+                    {"name": "returnData", "type": "bytes"}
+                ],
+                "name": "returnData",
+                "type": "tuple[]"
+            }
+        ],
+        "stateMutability": "payable",
+        "type": "function"
+    },
     {
-        "constant": True,
-        "inputs": [{"name": "_owner", "type": "address"}],
-        "name": "balanceOf",
+        "inputs": [{"name": "addr", "type": "address"}],
+        "name": "getEthBalance",
         "outputs": [{"name": "balance", "type": "uint256"}],
+        "stateMutability": "view",
         "type": "function"
     }
 ]
 
+multicall_contract = w3.eth.contract(address=MULTICALL3_ADDRESS, abi=MULTICALL3_ABI)
+
+http_session = None  # общий aiohttp.ClientSession, создаётся в main()
+
+COINGECKO_IDS = ",".join(info["coingecko_id"] for info in TOKENS.values() if info.get("coingecko_id"))
+COINGECKO_PRICES_URL = f"https://api.coingecko.com/api/v3/simple/price?ids={COINGECKO_IDS}&vs_currencies=usd"
+
+PRICE_CACHE_TTL = 600
 price_cache = {}
 price_cache_time = 0
+price_cache_etag = None
+price_lock = asyncio.Lock()
+
+BALANCE_CACHE_TTL = 10
+RPC_BATCH_SIZE = 50
+TRANSFER_LOOKBACK_BLOCKS = 200  # ~2.5 минуты блоков BSC, с запасом на интервал проверки
+balance_cache = {}  # {wallet_key: ({token: balance}, time)}
 
 async def get_token_prices():
-    global price_cache, price_cache_time
+    """Цены из CoinGecko; при ошибке отдаём последние известные"""
+    if time.monotonic() - price_cache_time < PRICE_CACHE_TTL and price_cache:
+        return price_cache
     
-    current_time = asyncio.get_event_loop().time()
+    # Одновременные вызовы (/balance и мониторинг) ждут один общий запрос
+    async with price_lock:
+        if time.monotonic() - price_cache_time < PRICE_CACHE_TTL and price_cache:
+            return price_cache
+        return await fetch_token_prices()
+
+async def fetch_token_prices():
+    global price_cache, price_cache_time, price_cache_etag
     
-    if current_time - price_cache_time < 300 and price_cache:
-        return price_cache
+    if not COINGECKO_IDS:
+        return {}
     
     try:
-        coin_ids = []
-        for token_info in TOKENS.values():
-            if token_info.get("coingecko_id"):
-                coin_ids.append(token_info["coingecko_id"])
-        
-        if not coin_ids:
-            return {}
+        # Если цены не менялись, CoinGecko ответит 304 без тела
+        headers = {"If-None-Match": price_cache_etag} if price_cache_etag and price_cache else {}
         
-        ids_string = ",".join(coin_ids)
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids={ids_string}&vs_currencies=usd"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    new_cache = {}
-                    for token_symbol, token_info in TOKENS.items():
-                        coingecko_id = token_info.get("coingecko_id")
-                        if coingecko_id and coingecko_id in data:
-                            new_cache[token_symbol] = data[coingecko_id]["usd"]
-                    
-                    price_cache = new_cache
-                    price_cache_time = current_time
-                    logger.info(f"Цены обновлены")
-                    return price_cache
+        async with http_session.get(COINGECKO_PRICES_URL, headers=headers) as response:
+            if response.status == 304:
+                price_cache_time = time.monotonic()
+                logger.debug("Цены не изменились")
+                return price_cache
+            
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+                
+                price_cache = {
+                    token_symbol: data[token_info["coingecko_id"]]["usd"]
+                    for token_symbol, token_info in TOKENS.items()
+                    if token_info.get("coingecko_id") in data
+                }
+                price_cache_time = time.monotonic()
+                price_cache_etag = response.headers.get("ETag")
+                logger.info("Цены обновлены")
+                return price_cache
+            
+            logger.error("CoinGecko ответил %d, используем старые цены", response.status)
     
     except Exception as e:
-        logger.error(f"Ошибка получения цен: {e}")
+        logger.error("Ошибка получения цен: %s", e)
     
     return price_cache
 
 def format_usd(amount, token_symbol):
     if token_symbol in price_cache:
-        usd_value = amount * price_cache[token_symbol]
-        return f" (${usd_value:,.2f})"
+        return _format_usd_cents(round(amount * price_cache[token_symbol], 2))
     return ""
 
+@lru_cache(maxsize=4096)
+def _format_usd_cents(usd_value):
+    return f" (${usd_value:,.2f})"
+
+# Кошельков и контрактов единицы, поэтому производные формы адреса считаем один раз
+@lru_cache(maxsize=1024)
+def address_key(address):
+    """Адрес как 20 байт: не зависит от регистра и сравнивается без аллокаций"""
+    return bytes.fromhex(address[2:])
+
+@lru_cache(maxsize=1024)
+def wallet_topic(address):
+    """Адрес, дополненный до 32 байт, — в таком виде он лежит в topics события Transfer"""
+    return bytes(12) + address_key(address)
+
+TOKEN_BY_ADDRESS = {address_key(info["address"]): symbol for symbol, info in TOKENS.items() if info["address"]}
+
+PROCESSED_TXS_LIMIT = 1000
+
+def processed_key(tx_hash, wallet_key):
+    """8 байт хэша транзакции + 6 байт адреса кошелька (wallet_key — результат address_key)"""
+    return bytes.fromhex(tx_hash[2:18]) + wallet_key[:6]
+
 class SimpleDB:
     def __init__(self):
         self.wallets = []
         self.balances = {}  # {wallet_address: {token: balance}}
+        self.wallet_topics = {}  # {32-байтный topic адреса: кошелёк}
+        self.processed = OrderedDict()  # транзакции, по которым уже был алерт, от старых к новым
+        self.dirty = False  # есть изменения, которые ещё не записаны на диск
+        self.save_lock = asyncio.Lock()
         self.load()
     
     def load(self):
         try:
             if os.path.exists("data.json"):
-                with open("data.json", "r") as f:
-                    data = json.load(f)
+                with open("data.json", "rb") as f:
+                    data = orjson.loads(f.read())
                     self.wallets = data.get("wallets", [])
                     self.balances = data.get("balances", {})
+                    self.processed = OrderedDict.fromkeys(
+                        bytes.fromhex(key) for key in data.get("processed", [])[-PROCESSED_TXS_LIMIT:]
+                    )
+            self.wallet_topics = {wallet_topic(w["address"]): w for w in self.wallets}
         except Exception as e:
-            logger.error(f"Ошибка загрузки БД: {e}")
+            logger.error("Ошибка загрузки БД: %s", e)
     
-    def save(self):
+    def _write(self, payload):
+        """True, если БД записана на диск"""
+        # Пишем во временный файл и подменяем атомарно: падение посреди записи не портит БД
         try:
-            with open("data.json", "w") as f:
-                json.dump({
-                    "wallets": self.wallets,
-                    "balances": self.balances
-                }, f, indent=2)
+            with open("data.json.tmp", "wb") as f:
+                f.write(payload)
+            os.replace("data.json.tmp", "data.json")
+            return True
         except Exception as e:
-            logger.error(f"Ошибка сохранения БД: {e}")
+            logger.error("Ошибка сохранения БД: %s", e)
+            return False
+    
+    async def save(self):
+        """Снимок делаем в event loop, а запись на диск — в отдельном потоке"""
+        # Флаг снимаем вместе со снимком: изменения во время записи снова его поднимут
+        self.dirty = False
+        payload = orjson.dumps({
+            "wallets": self.wallets,
+            "balances": self.balances,
+            "processed": [key.hex() for key in self.processed]
+        })
+        async with self.save_lock:
+            if not await asyncio.to_thread(self._write, payload):
+                # Запись не удалась — повторим при следующем flush()
+                self.dirty = True
     
-    def add_wallet(self, address, name="Main"):
+    async def add_wallet(self, address, name="Main"):
         wallet = {
             "address": address,
             "name": name
         }
         
-        for existing_wallet in self.wallets:
-            if existing_wallet["address"].lower() == address.lower():
-                return False
+        topic = wallet_topic(address)
+        if topic in self.wallet_topics:
+            return False
         
         self.wallets.append(wallet)
-        self.save()
-        logger.info(f"Кошелёк добавлен: {name}")
+        self.wallet_topics[topic] = wallet
+        await self.save()
+        logger.info("Кошелёк добавлен: %s", name)
         return True
     
-    def remove_wallet(self, index):
+    async def remove_wallet(self, index):
         try:
             if 0 <= index < len(self.wallets):
                 removed = self.wallets.pop(index)
+                self.wallet_topics.pop(wallet_topic(removed["address"]), None)
                 addr_lower = removed["address"].lower()
                 if addr_lower in self.balances:
                     del self.balances[addr_lower]
-                self.save()
-                logger.info(f"Кошелёк удалён: {removed['name']}")
+                await self.save()
+                logger.info("Кошелёк удалён: %s", removed["name"])
                 return True, removed
             return False, None
         except Exception as e:
-            logger.error(f"Ошибка удаления кошелька: {e}")
+            logger.error("Ошибка удаления кошелька: %s", e)
             return False, None
     
-    def get_balance(self, wallet_address, token_symbol):
-        addr_lower = wallet_address.lower()
-        if addr_lower not in self.balances:
-            return None
-        return self.balances[addr_lower].get(token_symbol)
+    def get_wallet_balances(self, wallet_address):
+        return self.balances.get(wallet_address.lower(), {})
     
     def set_balance(self, wallet_address, token_symbol, balance):
+        """Записывается на диск при следующем flush()"""
         addr_lower = wallet_address.lower()
         if addr_lower not in self.balances:
             self.balances[addr_lower] = {}
         self.balances[addr_lower][token_symbol] = balance
-        self.save()
+        self.dirty = True
+    
+    async def flush(self):
+        if self.dirty:
+            await self.save()
+    
+    def is_processed(self, tx_hash, wallet_key):
+        return processed_key(tx_hash, wallet_key) in self.processed
+    
+    def mark_processed(self, tx_hash, wallet_key):
+        """Записывается на диск при следующем flush()"""
+        self.processed[processed_key(tx_hash, wallet_key)] = None
+        # Старые транзакции уже не попадут в окно поиска — вытесняем по одной, O(1)
+        if len(self.processed) > PROCESSED_TXS_LIMIT:
+            self.processed.popitem(last=False)
+        self.dirty = True
 
 db = SimpleDB()
 
@@ -200,121 +330,301 @@ def get_balance_sync(address, token_symbol):
         address = Web3.to_checksum_address(address)
         
         if token_symbol == "BNB":
-            balance_wei = w3.eth.get_balance(address)
-            balance = w3.from_wei(balance_wei, 'ether')
+            balance_raw = w3.eth.get_balance(address)
         else:
-            token_info = TOKENS[token_symbol]
-            token_address = Web3.to_checksum_address(token_info["address"])
-            contract = w3.eth.contract(address=token_address, abi=ERC20_ABI)
-            balance_raw = contract.functions.balanceOf(address).call()
-            balance = balance_raw / (10 ** token_info["decimals"])
+            return_data = w3.eth.call({"to": TOKEN_CONTRACTS[token_symbol], "data": BALANCE_OF_SELECTOR + wallet_topic(address)})
+            balance_raw = int.from_bytes(return_data, "big")
         
-        return float(balance)
+        return balance_raw * TOKEN_SCALES[token_symbol]
     except Exception as e:
-        logger.error(f"Ошибка получения баланса {token_symbol}: {e}")
+        logger.error("Ошибка получения баланса %s: %s", token_symbol, e)
         return 0.0
 
-async def get_balance(address, token_symbol):
-    return await asyncio.to_thread(get_balance_sync, address, token_symbol)
+def get_balances_batch_sync(pairs):
+    """Запасной путь без Multicall3: запросы уходят JSON-RPC batch'ами по RPC_BATCH_SIZE"""
+    balances = []
+    for start in range(0, len(pairs), RPC_BATCH_SIZE):
+        chunk = pairs[start:start + RPC_BATCH_SIZE]
+        try:
+            with w3.batch_requests() as batch:
+                for address, token_symbol in chunk:
+                    address = Web3.to_checksum_address(address)
+                    if token_symbol == "BNB":
+                        batch.add(w3.eth.get_balance(address))
+                    else:
+                        batch.add(w3.eth.call({"to": TOKEN_CONTRACTS[token_symbol], "data": BALANCE_OF_SELECTOR + wallet_topic(address)}))
+                results = batch.execute()
+            
+            balances.extend(
+                (result if token_symbol == "BNB" else int.from_bytes(result, "big")) * TOKEN_SCALES[token_symbol]
+                for (_, token_symbol), result in zip(chunk, results)
+            )
+        except Exception as e:
+            logger.error("Ошибка batch-запроса, читаю балансы по одному: %s", e)
+            balances.extend(get_balance_sync(address, token_symbol) for address, token_symbol in chunk)
+    
+    return balances
 
-async def get_recent_transactions_bscscan(wallet_address, token_symbol):
-    """Получаем последние транзакции через BSCScan API"""
+def get_balances_sync(addresses):
+    """Все балансы всех кошельков одним eth_call через Multicall3"""
+    pairs = [(address, token_symbol) for address in addresses for token_symbol in TOKENS]
+    calls = []
+    for address, token_symbol in pairs:
+        if token_symbol == "BNB":
+            target = MULTICALL3_ADDRESS
+            call_data = GET_ETH_BALANCE_SELECTOR + wallet_topic(address)
+        else:
+            target = TOKEN_CONTRACTS[token_symbol]
+            call_data = BALANCE_OF_SELECTOR + wallet_topic(address)
+        calls.append((target, True, call_data))
+    
+    try:
+        results = multicall_contract.functions.aggregate3(calls).call()
+    except Exception as e:
+        logger.error("Ошибка multicall, читаю балансы batch-запросом: %s", e)
+        results = [(False, b"")] * len(calls)
+    
+    balances = {}
+    failed = []
+    for (address, token_symbol), (success, return_data) in zip(pairs, results):
+        if success and len(return_data) == 32:
+            balance = int.from_bytes(return_data, "big") * TOKEN_SCALES[token_symbol]
+            balances.setdefault(address, {})[token_symbol] = balance
+        else:
+            failed.append((address, token_symbol))
+    
+    if failed:
+        for (address, token_symbol), balance in zip(failed, get_balances_batch_sync(failed)):
+            balances.setdefault(address, {})[token_symbol] = balance
+    
+    # Порядок токенов как в TOKENS — в нём их показывает /balance
+    return {
+        address: {token_symbol: balances[address][token_symbol] for token_symbol in TOKENS}
+        for address in addresses
+    }
+
+async def get_balances(addresses):
+    """Балансы {address: {token: balance}}; свежие значения берём из кэша"""
+    current_time = time.monotonic()
+    
+    stale = []
+    for address in addresses:
+        cached = balance_cache.get(address_key(address))
+        if not cached or current_time - cached[1] >= BALANCE_CACHE_TTL:
+            stale.append(address)
+    
+    if stale:
+        fetched = await asyncio.to_thread(get_balances_sync, stale)
+        for address, token_balances in fetched.items():
+            balance_cache[address_key(address)] = (token_balances, current_time)
+    
+    return {address: balance_cache[address_key(address)][0] for address in addresses}
+
+async def get_recent_transactions_bscscan(wallet_address, token_symbol="BNB"):
+    """Последние транзакции через BSCScan API: BNB — txlist, токены — tokentx (запасной путь без eth_getLogs)"""
     try:
         wallet_address = wallet_address.lower()
-        
         if token_symbol == "BNB":
-            # BNB транзакции
-            url = f"https://api.bscscan.com/api?module=account&action=txlist&address={wallet_address}&startblock=0&endblock=99999999&page=1&offset=10&sort=desc&apikey={BSCSCAN_API_KEY}"
+            url = f"https://api.bscscan.com/api?module=account&action=txlist&address={wallet_address}&startblock=0&endblock=99999999&page=1&offset=5&sort=desc&apikey={BSCSCAN_API_KEY}"
         else:
-            # ERC-20 транзакции
             token_address = TOKENS[token_symbol]["address"]
-            if not token_address:
-                return []
             url = f"https://api.bscscan.com/api?module=account&action=tokentx&contractaddress={token_address}&address={wallet_address}&page=1&offset=10&sort=desc&apikey={BSCSCAN_API_KEY}"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data["status"] == "1" and data["message"] == "OK":
-                        return data["result"][:5]  # Последние 5 транзакций
+        async with http_session.get(url) as response:
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+                if data["status"] == "1" and data["message"] == "OK":
+                    return data["result"]
         
         return []
     
     except Exception as e:
-        logger.error(f"Ошибка получения транзакций из BSCScan: {e}")
+        logger.error("Ошибка получения транзакций из BSCScan: %s", e)
         return []
 
-async def find_matching_transaction(wallet_address, token_symbol, expected_amount, direction):
-    """Ищем транзакцию которая соответствует изменению баланса"""
+async def rpc_batch(calls):
+    """JSON-RPC batch напрямую в BNB_RPC через общий http_session, минуя web3 и его middleware.
+    
+    calls — список (method, params); результаты возвращаются в том же порядке.
+    """
+    payload = [{"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+               for request_id, (method, params) in enumerate(calls)]
+    async with http_session.post(BNB_RPC, data=orjson.dumps(payload),
+                                 headers={"Content-Type": "application/json"}) as response:
+        response.raise_for_status()
+        replies = orjson.loads(await response.read())
+    
+    # На некорректный batch нода отвечает одной ошибкой, а не списком
+    if not isinstance(replies, list):
+        raise RuntimeError(f"RPC: {replies.get('error')}")
+    
+    results = [None] * len(calls)
+    for reply in replies:
+        if "error" in reply:
+            raise RuntimeError(f"RPC: {reply['error']}")
+        results[reply["id"]] = reply["result"]
+    return results
+
+async def get_transfer_logs(wallets_by_direction):
+    """Transfer-события всех наших токенов для кошельков за последние блоки; фильтрует сама нода.
+    
+    Фильтры всех направлений уходят одним JSON-RPC batch'ем. Логи нужны только сырые,
+    поэтому идём мимо web3: ни форматтеры ответа, ни POA middleware здесь не работают.
+    """
+    latest_block, = await rpc_batch([("eth_blockNumber", [])])
+    latest_block = int(latest_block, 16)
+    params = {
+        "fromBlock": hex(max(latest_block - TRANSFER_LOOKBACK_BLOCKS, 0)),
+        "toBlock": hex(latest_block),
+        "address": TOKEN_ADDRESSES
+    }
+    
+    calls = []
+    for direction, wallets in wallets_by_direction.items():
+        topics = ["0x" + wallet_topic(address).hex() for address in wallets]
+        topic_filter = [TRANSFER_EVENT_SIGNATURE, None, topics] if direction == "IN" else [TRANSFER_EVENT_SIGNATURE, topics]
+        calls.append(("eth_getLogs", [{**params, "topics": topic_filter}]))
+    return await rpc_batch(calls)
+
+# Найденный перевод; для токенов sender/recipient — hex-строки topics, пока событие не совпало с изменением
+Transfer = namedtuple("Transfer", "token sender recipient hash amount")
+# Изменение баланса кошелька за проход; amount — модуль разницы
+BalanceChange = namedtuple("BalanceChange", "address name token_symbol balance direction amount")
+
+def decode_transfer_log(log):
+    """Разбираем сырой Transfer-лог из JSON-RPC вручную, без ABI-декодера web3.
+    
+    Поля приходят hex-строками, поэтому topic сравниваем строкой, а data парсим int(..., 16):
+    перевод в байты ради сравнения или int.from_bytes был бы лишним шагом.
+    """
+    topics = log["topics"]
+    if len(topics) != 3 or topics[0] != TRANSFER_EVENT_SIGNATURE:
+        return None
+    
+    token_symbol = TOKEN_BY_ADDRESS.get(address_key(log["address"]))
+    if token_symbol is None:
+        return None
+    
+    # from/to остаются сырыми topics: hex-адреса нужны только для совпавшего события
+    return Transfer(
+        token_symbol,
+        topics[1],
+        topics[2],
+        log["transactionHash"],
+        int(log["data"], 16) * TOKEN_SCALES[token_symbol]
+    )
+
+# Признаки ответа «метод недоступен» — публичные ноды BSC так отвечают на eth_getLogs
+LOGS_UNAVAILABLE_HINTS = ("-32601", "not found", "not supported", "does not exist", "disabled", "not available", "not allowed")
+rpc_logs_available = True  # False — BNB_RPC отклонил eth_getLogs, токены сразу ищем через BSCScan
+
+async def get_recent_transfers(changes):
+    """Недавние Transfer-события для изменившихся токенов: {(wallet_topic, token, direction): [transfer, ...]}
+    
+    None — RPC не смог отдать логи (публичные ноды BSC отключают eth_getLogs), ищем через BSCScan.
+    """
+    global rpc_logs_available
+    
+    in_wallets = {change.address for change in changes
+                  if change.token_symbol != "BNB" and change.direction == "IN"}
+    out_wallets = {change.address for change in changes
+                   if change.token_symbol != "BNB" and change.direction == "OUT"}
+    wallets_by_direction = {direction: list(wallets) for direction, wallets in
+                            (("IN", in_wallets), ("OUT", out_wallets)) if wallets}
+    if not wallets_by_direction:
+        return {}
+    if not rpc_logs_available:
+        return None
+    
     try:
-        transactions = await get_recent_transactions_bscscan(wallet_address, token_symbol)
-        
-        if not transactions:
-            return None
-        
-        wallet_lower = wallet_address.lower()
-        
-        for tx in transactions:
-            if token_symbol == "BNB":
-                # BNB транзакция
-                tx_from = tx["from"].lower()
-                tx_to = tx["to"].lower()
-                amount = float(w3.from_wei(int(tx["value"]), 'ether'))
-                
-                # Проверяем направление и сумму
-                if direction == "IN" and tx_to == wallet_lower:
-                    if abs(amount - expected_amount) < 0.0001:
-                        return {
-                            "from": tx["from"],
-                            "to": tx["to"],
-                            "hash": tx["hash"],
-                            "amount": amount
-                        }
-                elif direction == "OUT" and tx_from == wallet_lower:
-                    if abs(amount - expected_amount) < 0.0001:
-                        return {
-                            "from": tx["from"],
-                            "to": tx["to"],
-                            "hash": tx["hash"],
-                            "amount": amount
-                        }
-            else:
-                # ERC-20 транзакция
-                tx_from = tx["from"].lower()
-                tx_to = tx["to"].lower()
-                decimals = TOKENS[token_symbol]["decimals"]
-                amount = int(tx["value"]) / (10 ** decimals)
-                
-                # Проверяем направление и сумму
-                if direction == "IN" and tx_to == wallet_lower:
-                    if abs(amount - expected_amount) < 0.001:  # Больше погрешность для токенов
-                        return {
-                            "from": tx["from"],
-                            "to": tx["to"],
-                            "hash": tx["hash"],
-                            "amount": amount
-                        }
-                elif direction == "OUT" and tx_from == wallet_lower:
-                    if abs(amount - expected_amount) < 0.001:
-                        return {
-                            "from": tx["from"],
-                            "to": tx["to"],
-                            "hash": tx["hash"],
-                            "amount": amount
-                        }
-        
+        all_logs = await get_transfer_logs(wallets_by_direction)
+    except Exception as e:
+        if any(hint in str(e).lower() for hint in LOGS_UNAVAILABLE_HINTS):
+            # Нода не отдаёт логи вообще — больше не тратим на неё запросы
+            rpc_logs_available = False
+            logger.warning("BNB_RPC не поддерживает eth_getLogs, токены ищем через BSCScan: %s", e)
+        else:
+            logger.error("Ошибка получения Transfer-событий, ищем через BSCScan: %s", e)
         return None
     
+    # Один проход по событиям: раскладываем по кошельку, токену и направлению
+    transfers = {}
+    for direction, direction_logs in zip(wallets_by_direction, all_logs):
+        topic_index = 2 if direction == "IN" else 1
+        for log in direction_logs:
+            # Битый лог (например, пустая data) пропускаем, не теряя остальные события прохода
+            try:
+                transfer = decode_transfer_log(log)
+                if not transfer:
+                    continue
+                topic = bytes.fromhex(log["topics"][topic_index][2:])
+            except (KeyError, IndexError, ValueError) as e:
+                logger.error("Не удалось разобрать Transfer-лог: %s", e)
+                continue
+            if topic in db.wallet_topics:
+                transfers.setdefault((topic, transfer.token, direction), []).append(transfer)
+    return transfers
+
+async def find_matching_transaction(wallet_address, token_symbol, expected_amount, direction, transfers):
+    """Ищем транзакцию которая соответствует изменению баланса; transfers — задача get_recent_transfers"""
+    try:
+        if token_symbol == "BNB":
+            return await find_matching_bscscan_transaction(wallet_address, token_symbol, expected_amount, direction, 0.0001)
+        
+        recent_transfers = await transfers
+        if recent_transfers is None:
+            # Больше погрешность для токенов
+            return await find_matching_bscscan_transaction(wallet_address, token_symbol, expected_amount, direction, 0.001)
+        return find_matching_transfer(wallet_address, token_symbol, expected_amount, direction, recent_transfers)
+    
     except Exception as e:
-        logger.error(f"Ошибка поиска транзакции: {e}")
+        logger.error("Ошибка поиска транзакции: %s", e)
         return None
 
+async def find_matching_bscscan_transaction(wallet_address, token_symbol, expected_amount, direction, tolerance):
+    transactions = await get_recent_transactions_bscscan(wallet_address, token_symbol)
+    
+    # BSCScan отдаёт адреса в нижнем регистре
+    wallet_lower = wallet_address.lower()
+    wallet_key = address_key(wallet_address)
+    # Сторона транзакции, на которой должен быть наш кошелёк
+    side = "to" if direction == "IN" else "from"
+    scale = TOKEN_SCALES[token_symbol]
+    
+    for tx in transactions:
+        if tx[side] != wallet_lower or db.is_processed(tx["hash"], wallet_key):
+            continue
+        
+        amount = int(tx["value"]) * scale
+        if abs(amount - expected_amount) < tolerance:
+            return Transfer(token_symbol, tx["from"], tx["to"], tx["hash"], amount)
+    
+    return None
+
+def find_matching_transfer(wallet_address, token_symbol, expected_amount, direction, transfers):
+    wallet_key = address_key(wallet_address)
+    candidates = transfers.get((bytes(12) + wallet_key, token_symbol, direction), [])
+    
+    # Сначала самые свежие события
+    for transfer in reversed(candidates):
+        if db.is_processed(transfer.hash, wallet_key):
+            continue
+        
+        if abs(transfer.amount - expected_amount) < 0.001:  # Больше погрешность для токенов
+            return transfer._replace(
+                sender="0x" + transfer.sender[-40:],
+                recipient="0x" + transfer.recipient[-40:]
+            )
+    
+    return None
+
 def format_address(address):
     if not address:
         return ""
     return f"{address[:6]}...{address[-4:]}"
 
+# Одни и те же балансы выводятся в каждом /balance и алерте — форматируем один раз
+@lru_cache(maxsize=4096)
 def format_balance(amount):
     if amount == 0:
         return "0.0000"
@@ -325,6 +635,23 @@ def format_balance(amount):
     else:
         return f"{amount:.8f}"
 
+TELEGRAM_RATE_LIMIT = 30  # сообщений в секунду на бота
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+send_times = deque()
+send_lock = asyncio.Lock()
+
+async def wait_send_slot():
+    """Ждём, пока за последнюю секунду отправлено меньше TELEGRAM_RATE_LIMIT сообщений"""
+    async with send_lock:
+        now = time.monotonic()
+        while send_times and now - send_times[0] >= 1:
+            send_times.popleft()
+        
+        if len(send_times) >= TELEGRAM_RATE_LIMIT:
+            await asyncio.sleep(1 - (now - send_times.popleft()))
+        
+        send_times.append(time.monotonic())
+
 def is_authorized(user_id: int) -> bool:
     return user_id == TELEGRAM_USER_ID
 
@@ -355,15 +682,22 @@ async def cmd_balance(message: Message):
         await message.answer("Нет добавленных кошельков\nИспользуй /add_wallet")
         return
     
-    await get_token_prices()
+    now_utc = datetime.now(timezone.utc).strftime("%H:%M UTC")
+    # Снимок списка: /add_wallet и /remove_wallet могут сработать, пока ждём балансы
+    wallets = list(db.wallets)
     
-    for wallet in db.wallets:
+    # Цены и балансы не зависят друг от друга — запрашиваем одновременно
+    _, all_balances = await asyncio.gather(
+        get_token_prices(),
+        get_balances([wallet["address"] for wallet in wallets])
+    )
+    
+    # Все кошельки одним сообщением (или несколькими, если не влезает в лимит Telegram)
+    messages = []
+    for wallet in wallets:
         address = wallet["address"]
         name = wallet["name"]
-        
-        balances = {}
-        for token in TOKENS.keys():
-            balances[token] = await get_balance(address, token)
+        balances = all_balances[address]
         
         msg = f"Баланс: {name}\n"
         msg += f"{format_address(address)}\n\n"
@@ -372,9 +706,15 @@ async def cmd_balance(message: Message):
             usd_str = format_usd(amount, token)
             msg += f"{token}: {format_balance(amount)}{usd_str}\n"
         
-        now_utc = datetime.now(timezone.utc).strftime("%H:%M UTC")
         msg += f"\nобновлено: {now_utc}"
         
+        if messages and len(messages[-1]) + len(msg) + 2 <= TELEGRAM_MAX_MESSAGE_LENGTH:
+            messages[-1] += f"\n\n{msg}"
+        else:
+            messages.append(msg)
+    
+    for msg in messages:
+        await wait_send_slot()
         await message.answer(msg)
 
 @dp.message(Command("add_wallet"))
@@ -398,7 +738,7 @@ async def cmd_add_wallet(message: Message):
         await message.answer("Невалидный адрес BSC")
         return
     
-    if db.add_wallet(address, name):
+    if await db.add_wallet(address, name):
         await message.answer(
             f"✅ Кошелёк добавлен: {name}\n"
             f"{format_address(address)}\n\n"
@@ -449,7 +789,7 @@ async def cmd_remove_wallet(message: Message):
     
     try:
         wallet_num = int(args[1])
-        success, removed_wallet = db.remove_wallet(wallet_num - 1)
+        success, removed_wallet = await db.remove_wallet(wallet_num - 1)
         
         if success:
             await message.answer(
@@ -463,6 +803,154 @@ async def cmd_remove_wallet(message: Message):
     except ValueError:
         await message.answer("❌ Укажи номер кошелька (число)")
 
+def build_alert(name, token_symbol, direction, amount, current_balance, tx_details, now_utc):
+    """Текст алерта и параметры отправки: (text, parse_mode, disable_preview)"""
+    emoji = "🟢" if direction == "IN" else "🔴"
+    usd_str = format_usd(amount, token_symbol)
+    usd_balance = format_usd(current_balance, token_symbol)
+    
+    msg = f"{emoji} {direction} | {format_balance(amount)} {token_symbol}{usd_str}\n"
+    # Имя задаёт пользователь — в HTML-алерте его нужно экранировать
+    msg += f"Кошелёк: {html.escape(name) if tx_details else name}\n"
+    
+    if tx_details:
+        # Нашли транзакцию - показываем детали
+        if direction == "IN":
+            msg += f"From: {format_address(tx_details.sender)}\n"
+        else:
+            msg += f"To: {format_address(tx_details.recipient)}\n"
+        
+        msg += f"Новый баланс: {format_balance(current_balance)} {token_symbol}{usd_balance}\n"
+        msg += f"<a href='https://bscscan.com/tx/{tx_details.hash}'>Tx</a>"
+        return msg, "HTML", True
+    
+    # Не нашли - простой алерт
+    msg += f"Новый баланс: {format_balance(current_balance)} {token_symbol}{usd_balance}\n"
+    msg += f"\n🕐 {now_utc}"
+    return msg, None, False
+
+ALERT_SEND_ATTEMPTS = 3  # сколько раз выполняем требование Telegram подождать (RetryAfter)
+
+async def send_alert(text, parse_mode, disable_preview):
+    """False — временная ошибка, алерт стоит повторить на следующем проходе.
+    
+    True — алерт отправлен или отброшен насовсем (BadRequest, Forbidden): повтор не поможет.
+    """
+    for _ in range(ALERT_SEND_ATTEMPTS):
+        try:
+            await wait_send_slot()
+            await bot.send_message(
+                chat_id=TELEGRAM_USER_ID,
+                text=text,
+                parse_mode=parse_mode,
+                disable_web_page_preview=disable_preview
+            )
+            logger.info("✅ Алерт отправлен!")
+            return True
+        except TelegramRetryAfter as e:
+            logger.error("❌ Лимит Telegram, ждём %d сек", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            logger.error("❌ Ошибка отправки алерта, повторим позже: %s", e)
+            return False
+        except Exception as e:
+            logger.error("❌ Алерт отброшен: %s", e)
+            return True
+    return False
+
+# Очередь алертов: мониторинг не ждёт Telegram, отправкой занимается send_alerts()
+ALERT_QUEUE_SIZE = 1024
+ALERT_DRAIN_TIMEOUT = 10  # сколько при остановке ждём отправки оставшихся алертов
+alert_queue = asyncio.Queue(maxsize=ALERT_QUEUE_SIZE)
+pending_alerts = set()  # (wallet_key, token) с алертом в очереди — мониторинг их пока не трогает
+
+async def send_alerts():
+    """Отправляем алерты из очереди по одному, в порядке появления.
+    
+    Баланс и обработанную транзакцию фиксируем, только если send_alert() не просит повтора:
+    алерт с временной ошибкой не попадёт в БД, и следующий проход увидит то же изменение.
+    """
+    while True:
+        change, tx_details, alert = await alert_queue.get()
+        try:
+            # Кошелёк могли удалить, пока алерт ждал в очереди: его баланс в БД не возвращаем,
+            # иначе при повторном добавлении старое значение даст ложный алерт
+            if await send_alert(*alert) and wallet_topic(change.address) in db.wallet_topics:
+                if tx_details:
+                    db.mark_processed(tx_details.hash, address_key(change.address))
+                db.set_balance(change.address, change.token_symbol, change.balance)
+        finally:
+            pending_alerts.discard((address_key(change.address), change.token_symbol))
+            alert_queue.task_done()
+
+balance_check_event = asyncio.Event()
+
+async def wait_next_check():
+    """Ждём 30 секунд или Transfer-событие по нашим кошелькам — что наступит раньше"""
+    try:
+        await asyncio.wait_for(balance_check_event.wait(), timeout=30)
+        # Баланс только что изменился — кэш уже устарел
+        balance_cache.clear()
+    except asyncio.TimeoutError:
+        pass
+    balance_check_event.clear()
+
+WS_RETRY_MIN = 5
+WS_RETRY_MAX = 300  # нода, которая не принимает подписку, не должна получать переподключения каждые 5 сек
+
+async def watch_transfers():
+    """Подписка eth_subscribe на Transfer-события кошельков; переподписываемся при изменении списка"""
+    logger.info("📡 Подписка на Transfer-события через WebSocket")
+    
+    retry_delay = WS_RETRY_MIN
+    while True:
+        subscribed = set(db.wallet_topics)
+        if not subscribed:
+            await asyncio.sleep(30)
+            continue
+        
+        topics = ["0x" + topic.hex() for topic in subscribed]
+        try:
+            async with http_session.ws_connect(BNB_WSS, heartbeat=30) as ws:
+                # Входящие (кошелёк в topic2) и исходящие (кошелёк в topic1)
+                for request_id, topic_filter in enumerate(([TRANSFER_EVENT_SIGNATURE, None, topics],
+                                                           [TRANSFER_EVENT_SIGNATURE, topics]), 1):
+                    await ws.send_str(orjson.dumps({
+                        "jsonrpc": "2.0",
+                        "id": request_id,
+                        "method": "eth_subscribe",
+                        "params": ["logs", {"address": TOKEN_ADDRESSES, "topics": topic_filter}]
+                    }).decode())
+                
+                confirmed = set()
+                while set(db.wallet_topics) == subscribed:
+                    try:
+                        msg = await ws.receive(timeout=30)
+                    except asyncio.TimeoutError:
+                        continue
+                    
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        logger.error("WebSocket закрыт: %s", msg.type)
+                        break
+                    reply = orjson.loads(msg.data)
+                    if reply.get("method") == "eth_subscription":
+                        balance_check_event.set()
+                    elif "result" in reply:
+                        # Обе подписки приняты — нода рабочая, сбрасываем паузу переподключения
+                        confirmed.add(reply.get("id"))
+                        if confirmed >= {1, 2}:
+                            retry_delay = WS_RETRY_MIN
+                    elif "error" in reply:
+                        # Нода отклонила eth_subscribe (метод не поддерживается, слишком много topics и т.п.)
+                        logger.error("Подписка %s отклонена: %s", reply.get("id"), reply["error"])
+                        break
+        
+        except Exception as e:
+            logger.error("Ошибка WebSocket-подписки: %s", e)
+        
+        await asyncio.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, WS_RETRY_MAX)
+
 async def check_balances():
     """Мониторинг балансов: проверяем каждые 30 секунд"""
     logger.info("⏰ Мониторинг балансов запущен (проверка каждые 30 сек)")
@@ -473,103 +961,133 @@ async def check_balances():
                 await asyncio.sleep(30)
                 continue
             
-            await get_token_prices()
+            now_utc = datetime.now(timezone.utc).strftime("%H:%M UTC")
+            # Снимок списка: команды бота могут изменить db.wallets, пока ждём балансы
+            wallets = list(db.wallets)
+            _, all_balances = await asyncio.gather(
+                get_token_prices(),
+                get_balances([wallet["address"] for wallet in wallets])
+            )
             
-            for wallet in db.wallets:
+            changes = []
+            for wallet in wallets:
                 address = wallet["address"]
                 name = wallet["name"]
+                if wallet_topic(address) not in db.wallet_topics:
+                    # Кошелёк удалили, пока ждали балансы — не оставляем его баланс в БД
+                    continue
                 
-                logger.info(f"🔍 Проверяю балансы для {name}")
+                logger.debug("🔍 Проверяю балансы для %s", name)
+                current_balances = all_balances[address]
+                old_balances = db.get_wallet_balances(address)
                 
                 for token_symbol in TOKENS.keys():
-                    current_balance = await get_balance(address, token_symbol)
-                    old_balance = db.get_balance(address, token_symbol)
+                    if (address_key(address), token_symbol) in pending_alerts:
+                        # Прошлый алерт ещё не доставлен — баланс в БД обновится после отправки
+                        continue
+                    
+                    current_balance = current_balances[token_symbol]
+                    old_balance = old_balances.get(token_symbol)
                     
                     if old_balance is None:
                         # Первая проверка - просто сохраняем
                         db.set_balance(address, token_symbol, current_balance)
-                        logger.info(f"📝 Начальный баланс {token_symbol}: {current_balance}")
+                        logger.info("📝 Начальный баланс %s: %s", token_symbol, current_balance)
                         continue
                     
                     # Проверяем изменение
                     diff = current_balance - old_balance
                     
                     if abs(diff) > 0.0001:  # Изменение больше 0.0001
-                        logger.info(f"💰 ИЗМЕНЕНИЕ! {name} {token_symbol} diff={diff}")
-                        
+                        logger.info("💰 ИЗМЕНЕНИЕ! %s %s diff=%s", name, token_symbol, diff)
                         direction = "IN" if diff > 0 else "OUT"
-                        amount = abs(diff)
-                        
-                        # Пытаемся найти детали транзакции
-                        tx_details = await find_matching_transaction(address, token_symbol, amount, direction)
-                        
-                        emoji = "🟢" if direction == "IN" else "🔴"
-                        usd_str = format_usd(amount, token_symbol)
-                        usd_balance = format_usd(current_balance, token_symbol)
-                        
-                        msg = f"{emoji} {direction} | {format_balance(amount)} {token_symbol}{usd_str}\n"
-                        msg += f"Кошелёк: {name}\n"
-                        
-                        if tx_details:
-                            # Нашли транзакцию - показываем детали
-                            if direction == "IN":
-                                msg += f"From: {format_address(tx_details['from'])}\n"
-                            else:
-                                msg += f"To: {format_address(tx_details['to'])}\n"
-                            
-                            msg += f"Новый баланс: {format_balance(current_balance)} {token_symbol}{usd_balance}\n"
-                            msg += f"<a href='https://bscscan.com/tx/{tx_details['hash']}'>Tx</a>"
-                            
-                            parse_mode = "HTML"
-                            disable_preview = True
-                            logger.info(f"✅ Найдена транзакция: {tx_details['hash'][:10]}...")
-                        else:
-                            # Не нашли - простой алерт
-                            msg += f"Новый баланс: {format_balance(current_balance)} {token_symbol}{usd_balance}\n"
-                            now_utc = datetime.now(timezone.utc).strftime("%H:%M UTC")
-                            msg += f"\n🕐 {now_utc}"
-                            
-                            parse_mode = None
-                            disable_preview = False
-                        
-                        try:
-                            await bot.send_message(
-                                chat_id=TELEGRAM_USER_ID,
-                                text=msg,
-                                parse_mode=parse_mode,
-                                disable_web_page_preview=disable_preview
-                            )
-                            logger.info(f"✅ Алерт отправлен!")
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка отправки алерта: {e}")
-                        
-                        # Обновляем баланс
-                        db.set_balance(address, token_symbol, current_balance)
+                        changes.append(BalanceChange(address, name, token_symbol, current_balance, direction, abs(diff)))
+            
+            # Ищем детали транзакций для всех изменений параллельно:
+            # запросы в BSCScan по BNB идут одновременно с eth_getLogs по токенам
+            # Задачу с логами создаём только под изменения токенов и не оставляем после прохода
+            transfers = None
+            if any(change.token_symbol != "BNB" for change in changes):
+                transfers = asyncio.ensure_future(get_recent_transfers(changes))
+            try:
+                all_tx_details = await asyncio.gather(*(
+                    find_matching_transaction(change.address, change.token_symbol, change.amount, change.direction, transfers)
+                    for change in changes
+                ))
+            finally:
+                if transfers:
+                    transfers.cancel()
+            
+            # Отдаём алерты в очередь и сразу идём дальше; ждём только если очередь переполнена.
+            # Баланс и транзакцию в БД записывает send_alerts() после доставки
+            for change, tx_details in zip(changes, all_tx_details):
+                if tx_details:
+                    logger.info("✅ Найдена транзакция: %.10s...", tx_details.hash)
+                alert = build_alert(change.name, change.token_symbol, change.direction, change.amount,
+                                    change.balance, tx_details, now_utc)
+                await alert_queue.put((change, tx_details, alert))
+                pending_alerts.add((address_key(change.address), change.token_symbol))
             
-            await asyncio.sleep(30)  # Проверка каждые 30 секунд
+            # Одна запись на диск за проход вместо записи на каждый баланс
+            await db.flush()
+            
+            await wait_next_check()
             
         except Exception as e:
-            logger.error(f"❌ Ошибка мониторинга: {e}")
+            logger.error("❌ Ошибка мониторинга: %s", e)
             await asyncio.sleep(30)
 
 async def main():
+    global http_session
+    
     logger.info("🚀 Бот запускается")
     
-    is_connected = w3.is_connected()
+    http_session = aiohttp.ClientSession(
+        # keepalive дольше интервала проверки, чтобы соединения переживали паузу между проходами
+        connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=75),
+        timeout=aiohttp.ClientTimeout(total=10)
+    )
+    try:
+        await run()
+    finally:
+        await http_session.close()
+
+async def run():
+    is_connected = await asyncio.to_thread(w3.is_connected)
     if is_connected:
-        block_num = w3.eth.block_number
-        logger.info(f"✅ BSC подключен (блок: {block_num})")
+        block_num = await asyncio.to_thread(lambda: w3.eth.block_number)
+        logger.info("✅ BSC подключен (блок: %d)", block_num)
     else:
         logger.error("❌ Ошибка подключения к BSC")
         return
     
     await get_token_prices()
     
-    logger.info(f"📊 Загружено кошельков: {len(db.wallets)}")
+    logger.info("📊 Загружено кошельков: %d", len(db.wallets))
     
-    # Запускаем мониторинг и бота параллельно
-    asyncio.create_task(check_balances())
-    await dp.start_polling(bot)
+    # Запускаем мониторинг и бота параллельно; ссылки на задачи держим, чтобы их не собрал GC
+    tasks = [asyncio.create_task(check_balances())]
+    if BNB_WSS:
+        tasks.append(asyncio.create_task(watch_transfers()))
+    sender = asyncio.create_task(send_alerts())
+    try:
+        # Сессию бота закрываем сами: после остановки polling ещё досылаем алерты
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        # Новых алертов уже не будет — досылаем очередь; недоставленные повторятся после перезапуска
+        try:
+            await asyncio.wait_for(alert_queue.join(), timeout=ALERT_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Не отправлено алертов: %d, повторим после перезапуска", alert_queue.qsize())
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+        
+        await db.flush()
+        await bot.session.close()
 
 if __name__ == "__main__":
     asyncio.run(main())